@@ -1,18 +1,43 @@
 import os
+import asyncio
 import logging
 import pickle
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
+from firebase_admin import firestore
 import pandas as pd
 import numpy as np
-from webhook import router as whatsapp_router
+from webhook import (
+    router as whatsapp_router,
+    start_wa_sender, stop_wa_sender,
+    open_support_client, close_support_client,
+    warm_dateparser,
+)
 from firebase_config import init_firebase
 from fastapi import FastAPI
 from support_and_reports import router as support_router
 
-app = FastAPI()
+# ----------------- Firestore Thread Pool -----------------
+# Blocking Firestore calls run here instead of on the event loop
+FIRESTORE_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="firestore")
+
+# ----------------- Lifespan -----------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    asyncio.get_running_loop().set_default_executor(FIRESTORE_POOL)
+    await start_wa_sender()
+    await open_support_client()
+    await warm_dateparser()
+    yield
+    await stop_wa_sender()
+    await close_support_client()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 app.include_router(whatsapp_router)
 app.include_router(support_router)
 db = init_firebase()
@@ -21,7 +46,7 @@ db = init_firebase()
 def home():
     return {"message": "Backend running"}
 # ----------------- Logging -----------------
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 
@@ -65,14 +90,19 @@ doctorLimits = {
 }
 
 # ----------------- Helper Functions -----------------
+@firestore.transactional
+def _next_patient_count(transaction, doc_ref):
+    doc = doc_ref.get(transaction=transaction)
+    count = doc.to_dict().get("count", 1000) + 1 if doc.exists else 1001
+    transaction.set(doc_ref, {"count": count})
+    return count
+
 def generate_patient_id():
     if db is None:
         raise RuntimeError("Firestore not initialized")
+    # Transactional so registrations running in parallel threads get distinct IDs
     doc_ref = db.collection("metadata").document("patient_counter")
-    doc = doc_ref.get()
-    count = doc.to_dict().get("count", 1000) + 1 if doc.exists else 1001
-    doc_ref.set({"count": count})
-    return f"P{count}"
+    return f"P{_next_patient_count(db.transaction(), doc_ref)}"
 
 def store_patient(p: dict):
     if db is None:
@@ -94,11 +124,11 @@ def store_patient(p: dict):
 async def register_patient(request: Request):
     try:
         # 1️⃣ Get data from frontend
-        patient_payload = await request.json()
+        patient_payload = orjson.loads(await request.body())
         logger.info(f"📥 Received registration: {patient_payload}")
 
         # 2️⃣ Store in Firestore
-        pid = store_patient(patient_payload)
+        pid = await asyncio.to_thread(store_patient, patient_payload)
         logger.info(f"✅ Stored patient: {pid}")
 
         # 3️⃣ Create message
@@ -134,7 +164,7 @@ async def predict(request: Request):
         if model is None:
             return JSONResponse({"error": "Model not loaded"})
 
-        body = await request.json()
+        body = orjson.loads(await request.body())
         target_date = body.get("date")
         department = body.get("department")
 
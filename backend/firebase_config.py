@@ -2,7 +2,7 @@ import os
 import json
 import logging
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore, firestore_async
 
 logger = logging.getLogger("app")
 
@@ -30,3 +30,8 @@ def init_firebase():
     # ❗ DO NOT load from file — prevent fallback
     logger.error("❌ FIREBASE_CREDENTIALS missing. Refusing to load from file.")
     raise ValueError("FIREBASE_CREDENTIALS missing")
+
+def init_firebase_async():
+    # Same app/credentials, but an AsyncClient whose calls don't block the event loop
+    init_firebase()
+    return firestore_async.client()
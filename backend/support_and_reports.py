@@ -1,8 +1,10 @@
 import os
 import io
+import asyncio
 import logging
+import orjson
 from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from firebase_admin import firestore
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
@@ -10,14 +12,14 @@ from reportlab.pdfgen import canvas
 # If firebase is already initialized in your project, no need to reinitialize
 db = firestore.client()
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger("support_reports")
 
 
 # ---------------- NLP SUPPORT --------------------
 @router.post("/nlp_support")
 async def nlp_support(req: Request):
-    data = await req.json()
+    data = orjson.loads(await req.body())
     query = data.get("query", "").lower()
 
     if not query:
@@ -41,21 +43,7 @@ async def nlp_support(req: Request):
 
 
 # --------------- DYNAMIC PDF GENERATION ----------------
-@router.get("/reports/{patient_id}")
-async def generate_pdf(patient_id: str):
-
-    # Ensure patient ID starts with P
-    if patient_id.isdigit():
-        patient_id = "P" + patient_id
-
-    doc_ref = db.collection("patients").document(patient_id)
-    doc = doc_ref.get()
-
-    if not doc.exists:
-        raise HTTPException(status_code=404, detail="Patient not found")
-
-    pdata = doc.to_dict()
-
+def render_report_pdf(pdata: dict):
     # Start PDF buffer
     buffer = io.BytesIO()
     p = canvas.Canvas(buffer, pagesize=A4)
@@ -75,6 +63,23 @@ async def generate_pdf(patient_id: str):
     p.save()
 
     buffer.seek(0)
+    return buffer
+
+
+@router.get("/reports/{patient_id}")
+async def generate_pdf(patient_id: str):
+
+    # Ensure patient ID starts with P
+    if patient_id.isdigit():
+        patient_id = "P" + patient_id
+
+    doc = await asyncio.to_thread(db.collection("patients").document(patient_id).get)
+
+    if not doc.exists:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    # reportlab is synchronous; render off the event loop
+    buffer = await asyncio.to_thread(render_report_pdf, doc.to_dict())
 
     return StreamingResponse(
         buffer,
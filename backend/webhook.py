@@ -1,21 +1,32 @@
 import os
 import re
+import importlib
+import random
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import List, Dict
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timedelta, date as dt_date, time as dt_time
+from functools import lru_cache
+from time import monotonic
+from typing import List, Dict, Optional
 
 import httpx
-from fastapi import APIRouter, Request, HTTPException
+import orjson
+from cachetools import TTLCache
+from fastapi import APIRouter, BackgroundTasks, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 from firebase_admin import firestore
-import dateparser
 
-from firebase_config import init_firebase
+from firebase_config import init_firebase_async
 
 # ---------------- INIT ----------------
-db = init_firebase()
-router = APIRouter()
+db = init_firebase_async()
+REG_STATE_COL = db.collection("registration_states")
+PATIENTS_COL = db.collection("patients")
+router = APIRouter(default_response_class=ORJSONResponse)
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger("webhook")
 
 # ---------------- CONFIG ----------------
@@ -48,73 +59,215 @@ doctorLimits = {
     "Dermatology": 15,
 }
 
-DEPARTMENTS = list(doctorSchedule.keys())
+DEPARTMENTS = tuple(doctorSchedule)
+DEPT_ROWS = [{"id": d, "title": d} for d in DEPARTMENTS]
+
+# Typed department names/short forms -> department; longest alias wins
+DEPT_ALIASES = {d.lower(): d for d in DEPARTMENTS}
+DEPT_ALIASES.update({
+    "cardio": "Cardiology",
+    "neuro": "Neurology",
+    "ortho": "Orthopedics",
+    "pediatric": "Pediatrics",
+    "general": "General Medicine",
+    "derma": "Dermatology",
+    "skin": "Dermatology",
+})
+# Whole words only, so "asking" isn't "skin" and "generally" isn't "general"
+_DEPT_RE = re.compile(
+    r"\b(?:" + "|".join(map(re.escape, sorted(DEPT_ALIASES, key=len, reverse=True))) + r")\b"
+)
 
 # ---------------- WHATSAPP HELPERS ----------------
-async def wa_post(payload: dict):
-    async with httpx.AsyncClient(timeout=15) as client:
-        await client.post(
-            WA_API,
-            headers={"Authorization": f"Bearer {WHATSAPP_TOKEN}"},
-            json=payload,
-        )
+# One pooled client for the process so sends reuse keep-alive connections
+WA_CLIENT: Optional[httpx.AsyncClient] = None
+
+WA_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+WA_MAX_ATTEMPTS = 4
+WA_MAX_RETRY_WAIT = 10
+
+async def wa_post_with_retry(body: bytes):
+    # Absorb Meta's burst 429/5xx, waiting as long as Retry-After asks
+    for attempt in range(1, WA_MAX_ATTEMPTS + 1):
+        delay = min(0.2 * 2 ** attempt, 2) + random.uniform(0, 0.2)
+        try:
+            r = await WA_CLIENT.post(WA_API, content=body)
+        except httpx.TransportError:
+            if attempt == WA_MAX_ATTEMPTS:
+                raise
+        else:
+            if r.status_code not in WA_RETRY_STATUSES or attempt == WA_MAX_ATTEMPTS:
+                return r
+            retry_after = r.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = min(int(retry_after), WA_MAX_RETRY_WAIT)
+            logger.warning("WhatsApp send got %s, retrying in %.1fs", r.status_code, delay)
+        await asyncio.sleep(delay)
+
+# Clients are opened/closed by the app lifespan in app.py
+async def start_wa_sender():
+    global WA_CLIENT
+    # Graph API speaks HTTP/2, so concurrent sends multiplex on one connection
+    WA_CLIENT = httpx.AsyncClient(
+        http2=True,
+        timeout=15,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60),
+        headers={
+            "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+            "Content-Type": "application/json",
+        },
+    )
+
+async def stop_wa_sender():
+    if WA_CLIENT is not None:
+        await WA_CLIENT.aclose()
+
+async def wa_post(to: str, body: bytes):
+    await wa_post_with_retry(body)
+
+def wa_envelope(to: str, msg_type: bytes, part: bytes) -> bytes:
+    # Splice already-encoded JSON into the fixed message envelope
+    return b'{"messaging_product":"whatsapp","to":%b,"type":"%b","%b":%b}' % (
+        orjson.dumps(to), msg_type, msg_type, part)
+
+# Fixed skeletons; only the body text and buttons/rows are filled per send
+_BUTTON_SHELL = b'{"type":"button","body":{"text":%b},"action":{"buttons":[%b]}}'
+_LIST_SHELL = (
+    b'{"type":"list","body":{"text":%b},'
+    b'"action":{"button":"Select","sections":[{"title":"Departments","rows":%b}]}}'
+)
+
+@lru_cache(maxsize=256)
+def _reply_button(bid: str, title: str) -> bytes:
+    # Slot and menu buttons repeat, so each is encoded once
+    return orjson.dumps({"type": "reply", "reply": {"id": bid, "title": title}})
+
+def button_interactive(body: str, buttons: List[Dict[str, str]]) -> bytes:
+    return _BUTTON_SHELL % (
+        orjson.dumps(body),
+        b",".join(_reply_button(b["id"], b["title"]) for b in buttons),
+    )
+
+def list_interactive(body: str, rows: List[Dict[str, str]]) -> bytes:
+    return _LIST_SHELL % (orjson.dumps(body), orjson.dumps(rows))
 
 async def send_text(to: str, text: str):
-    await wa_post({
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "text",
-        "text": {"body": text},
-    })
+    await wa_post(to, wa_envelope(to, b"text", orjson.dumps({"body": text})))
+
+async def send_interactive(to: str, interactive: bytes):
+    await wa_post(to, wa_envelope(to, b"interactive", interactive))
 
 async def send_buttons(to: str, body: str, buttons: List[Dict[str, str]]):
-    await wa_post({
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "interactive",
-        "interactive": {
-            "type": "button",
-            "body": {"text": body},
-            "action": {
-                "buttons": [
-                    {"type": "reply", "reply": {"id": b["id"], "title": b["title"]}}
-                    for b in buttons
-                ]
-            },
-        },
-    })
+    await send_interactive(to, button_interactive(body, buttons))
 
 async def send_list(to: str, body: str, rows: List[Dict[str, str]]):
-    await wa_post({
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "interactive",
-        "interactive": {
-            "type": "list",
-            "body": {"text": body},
-            "action": {
-                "button": "Select",
-                "sections": [{"title": "Departments", "rows": rows}],
-            },
-        },
-    })
-
-async def send_document(to: str, url: str, filename="report.pdf"):
-    await wa_post({
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "document",
-        "document": {"link": url, "filename": filename},
-    })
+    await send_interactive(to, list_interactive(body, rows))
+
+async def send_document(to: str, url: str, filename="report.pdf", caption: str = None):
+    document = {"link": url, "filename": filename}
+    if caption:
+        document["caption"] = caption
+    await wa_post(to, wa_envelope(to, b"document", orjson.dumps(document)))
+
+# Static menus are encoded once
+DEPT_LIST_INTERACTIVE = list_interactive("🏥 Select Department:", DEPT_ROWS)
+
+# ---------------- SUPPORT ----------------
+NLP_BREAKER_FAILS = 3
+NLP_BREAKER_OPEN_SEC = 30
+_nlp_breaker = {"fails": 0, "open_until": 0.0}
+SUPPORT_CLIENT: Optional[httpx.AsyncClient] = None
+
+async def open_support_client():
+    global SUPPORT_CLIENT
+    SUPPORT_CLIENT = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=60),
+    )
+
+async def close_support_client():
+    if SUPPORT_CLIENT is not None:
+        await SUPPORT_CLIENT.aclose()
+
+async def nlp_support_reply(text: str):
+    # Stop calling a dead NLP endpoint for a while after repeated failures
+    if monotonic() < _nlp_breaker["open_until"]:
+        return "⚠️ Support is temporarily unavailable."
+    try:
+        r = await SUPPORT_CLIENT.post(
+            NLP_SUPPORT_URL,
+            content=orjson.dumps({"query": text}),
+            headers={"Content-Type": "application/json"},
+        )
+        r.raise_for_status()
+        payload = orjson.loads(r.content)
+        if not isinstance(payload, dict):
+            raise ValueError(f"expected a JSON object, got {type(payload).__name__}")
+        answer = payload.get("answer", "Please be more specific.")
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning("NLP support call failed: %s", e)
+        _nlp_breaker["fails"] += 1
+        if _nlp_breaker["fails"] >= NLP_BREAKER_FAILS:
+            _nlp_breaker["open_until"] = monotonic() + NLP_BREAKER_OPEN_SEC
+            _nlp_breaker["fails"] = 0
+        return "⚠️ Support is temporarily unavailable."
+    _nlp_breaker["fails"] = 0
+    return answer
 
 # ---------------- UTIL ----------------
-def normalize_phone(p: str):
-    digits = re.sub(r"\D", "", p)
-    if len(digits) == 10:
-        return "+91" + digits
-    if len(digits) > 10:
-        return "+" + digits
-    return None
+_ISO_DATE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+FAST_DATE_FORMATS = ("%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d")
+RELATIVE_DAYS = {"today": 0, "tomorrow": 1, "day after tomorrow": 2}
+
+def parse_date(text: str):
+    # Relative phrases ("tomorrow") depend on the day, so it is part of the key
+    return _parse_date_cached(text.strip(), datetime.now().date())
+
+@lru_cache(maxsize=4096)
+def _parse_date_cached(text: str, today):
+    # Most users type the prompted YYYY-MM-DD; skip dateparser for that
+    m = _ISO_DATE.match(text)
+    if m:
+        try:
+            return datetime(int(m[1]), int(m[2]), int(m[3]))
+        except ValueError:
+            pass
+    try:
+        # Other ISO-8601 forms, e.g. "2025-12-10 10:00" or "2025-12-10T10:00"
+        return datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    for fmt in FAST_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+
+    text = text.lower()
+    if text in RELATIVE_DAYS:
+        return datetime.combine(today + timedelta(days=RELATIVE_DAYS[text]), datetime.min.time())
+    import dateparser  # heavy; imported lazily, see warm_dateparser
+    return dateparser.parse(text, languages=["en"])
+
+async def warm_dateparser():
+    # Load dateparser in a worker thread instead of on the cold-start path
+    _in_background(asyncio.to_thread(importlib.import_module, "dateparser"))
+
+_SLOT_TIME = re.compile(r"^\s*(\d{1,2})(?::(\d{2}))?\s*(am|pm)?\s*$", re.IGNORECASE)
+
+def parse_slot_time(text: str):
+    # Typed slot times ("10:30", "2pm", "2:30 PM") -> "HH:MM"
+    m = _SLOT_TIME.match(text)
+    if not m:
+        return None
+    h, minute = int(m[1]), int(m[2] or 0)
+    if m[3]:
+        if not 1 <= h <= 12:
+            return None
+        h = h % 12 + (12 if m[3].lower() == "pm" else 0)
+    if h > 23 or minute > 59:
+        return None
+    return f"{h:02d}:{minute:02d}"
 
 def generate_slots(start: str, end: str):
     slots = []
@@ -125,183 +278,343 @@ def generate_slots(start: str, end: str):
         t += timedelta(minutes=30)
     return slots
 
+# Schedules are constant, so each department's slot list is built once
+DEPT_SLOTS = {dept: tuple(generate_slots(start, end)) for dept, (start, end) in doctorSchedule.items()}
+
 # ---------------- STATE ----------------
 STATE_TIMEOUT_MIN = 10
-
-def get_state(sender: str):
-    ref = db.collection("registration_states").document(sender)
-    snap = ref.get()
+STATE_REFRESH_SEC = 60
+
+# sender -> (step, data, monotonic time of last Firestore write).
+# Reads are served from here; Firestore writes happen in background tasks.
+# Bounded LRU so idle senders don't accumulate in memory.
+# The cache is per process, so the webhook must run as a single worker
+# (e.g. gunicorn -w 1 -k uvicorn.workers.UvicornWorker app:app); another
+# worker would keep its own stale step/data for the same sender.
+if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+    raise RuntimeError("Webhook state is cached per process; run a single worker")
+STATE_CACHE_MAX = 10000
+_state_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_state_write_locks = weakref.WeakValueDictionary()
+_bg_tasks = set()
+
+def _cache_state(sender: str, step: str, data: dict, written_at: float):
+    _state_cache[sender] = (step, data, written_at)
+    _state_cache.move_to_end(sender)
+    if len(_state_cache) > STATE_CACHE_MAX:
+        _state_cache.popitem(last=False)
+
+def _in_background(coro):
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+
+def _state_lock(sender: str) -> asyncio.Lock:
+    return _state_write_locks.setdefault(sender, asyncio.Lock())
+
+async def _persist_state(sender: str, op: str, *args):
+    # Per-sender FIFO lock keeps writes for one sender in order
+    async with _state_lock(sender):
+        ref = REG_STATE_COL.document(sender)
+        try:
+            await getattr(ref, op)(*args)
+        except Exception:
+            logger.exception("Persisting state for %s failed", sender)
+
+def _state_expiry():
+    # Client-side expiry; a Firestore TTL policy on expireAt purges stale docs
+    return datetime.utcnow() + timedelta(minutes=STATE_TIMEOUT_MIN)
+
+async def get_state(sender: str):
+    cached = _state_cache.get(sender)
+    if not cached:
+        # Wait out queued writes so Firestore isn't read ahead of them
+        async with _state_lock(sender):
+            cached = _state_cache.get(sender)
+            if not cached:
+                return await _load_state(sender)
+    if monotonic() - cached[2] <= STATE_TIMEOUT_MIN * 60:
+        _state_cache.move_to_end(sender)
+        return {"step": cached[0], "data": dict(cached[1])}
+    reset_state(sender)
+    return {"step": None, "data": {}, "expireAt": None}
+
+async def _load_state(sender: str):
+    ref = REG_STATE_COL.document(sender)
+    snap = await ref.get(field_paths=["step", "data", "expireAt"])
     if not snap.exists:
-        return {"step": None, "data": {}, "updatedAt": None}
+        return {"step": None, "data": {}, "expireAt": None}
 
     state = snap.to_dict()
-    ts = state.get("updatedAt")
-    if ts and datetime.utcnow() - ts.replace(tzinfo=None) > timedelta(minutes=STATE_TIMEOUT_MIN):
-        ref.delete()
-        return {"step": None, "data": {}, "updatedAt": None}
+    expire_at = state.get("expireAt")
+    remaining = expire_at.replace(tzinfo=None) - datetime.utcnow() if expire_at else timedelta(0)
+    if remaining <= timedelta(0):
+        reset_state(sender)
+        return {"step": None, "data": {}, "expireAt": None}
+    age = timedelta(minutes=STATE_TIMEOUT_MIN) - remaining
+    _cache_state(sender, state.get("step"), dict(state.get("data", {})),
+                 monotonic() - age.total_seconds())
     return state
 
 def set_state(sender: str, step: str, data: dict):
-    db.collection("registration_states").document(sender).set({
+    # Skip rewriting an unchanged state unless expireAt needs pushing out
+    cached = _state_cache.get(sender)
+    if cached and cached[0] == step and cached[1] == data \
+            and monotonic() - cached[2] < STATE_REFRESH_SEC:
+        return
+    data = dict(data)
+    _cache_state(sender, step, data, monotonic())
+    _in_background(_persist_state(sender, "set", {
         "step": step,
         "data": data,
-        "updatedAt": firestore.SERVER_TIMESTAMP
-    })
+        "expireAt": _state_expiry(),
+    }))
+
+def update_state(sender: str, step: str, data: dict, **fields):
+    # Write only the changed data.* fields instead of re-sending the whole map
+    data.update(fields)
+    update = {f"data.{k}": v for k, v in fields.items()}
+    update["step"] = step
+    update["expireAt"] = _state_expiry()
+    _cache_state(sender, step, dict(data), monotonic())
+    _in_background(_persist_state(sender, "update", update))
 
 def reset_state(sender: str):
-    db.collection("registration_states").document(sender).delete()
+    # Cache a tombstone so reads don't fall through to the pending delete
+    _cache_state(sender, None, {}, monotonic())
+    _in_background(_persist_state(sender, "delete"))
+
+# ---------------- SLOTS ----------------
+SLOT_CAPACITY = 1
+
+@firestore.async_transactional
+async def _book_slot_tx(transaction, patient: dict):
+    # The slot's holders are read inside the transaction, so two concurrent
+    # bookings can't both see it free; patients stays the only record.
+    holders = PATIENTS_COL \
+        .where("Department", "==", patient["Department"]) \
+        .where("RegistrationDate", "==", patient["RegistrationDate"]) \
+        .where("RegistrationTime", "==", patient["RegistrationTime"]) \
+        .select(["RegistrationTime"]) \
+        .limit(SLOT_CAPACITY)
+    taken = [h async for h in await transaction.get(holders)]
+    if len(taken) >= SLOT_CAPACITY:
+        return False
+    transaction.create(PATIENTS_COL.document(patient["PatientID"]), patient)
+    return True
+
+async def book_slot(patient: dict):
+    return await _book_slot_tx(db.transaction(), patient)
 
 # ---------------- MENU ----------------
+WELCOME_TEXT = "🏥 *Welcome to NovaMed*\nChoose an option:"
+WELCOME_BUTTONS = (
+    {"id": "book", "title": "📅 Book Appointment"},
+    {"id": "report", "title": "📄 Get Report"},
+    {"id": "support", "title": "💬 Support"},
+)
+WELCOME_INTERACTIVE = button_interactive(WELCOME_TEXT, WELCOME_BUTTONS)
+
 async def show_menu(sender: str):
-    await send_buttons(sender, "🏥 *Welcome to NovaMed*\nChoose an option:", [
-        {"id": "book", "title": "📅 Book Appointment"},
-        {"id": "report", "title": "📄 Get Report"},
-        {"id": "support", "title": "💬 Support"},
-    ])
     set_state(sender, "menu", {})
+    await send_interactive(sender, WELCOME_INTERACTIVE)
 
 # ---------------- MAIN FLOW ----------------
-async def process_message(sender: str, text: str, msg: dict):
-    text_l = text.lower().strip()
-    state = get_state(sender)
-    step = state.get("step")
-    data = state.get("data", {})
-    now = datetime.now()
+MENU_TRIGGERS = frozenset({"hi", "hello", "menu", "restart", "0"})
+SUPPORT_EXIT_WORDS = frozenset({"exit", "bye", "quit"})
+
+# -------- MENU --------
+# Menu button id -> (next step, prompt)
+MENU_ACTIONS = {
+    "book": ("first", "👤 Enter *First Name*:"),
+    "report": ("report", "🆔 Enter *Patient ID* (e.g. P1012):"),
+    "support": ("support", "💬 Ask your question. Type *menu* to exit."),
+}
 
-    if text_l in ["hi", "hello", "menu", "restart", "0"]:
+async def handle_menu(sender: str, text: str, msg: dict, data: dict):
+    bid = msg.get("interactive", {}).get("button_reply", {}).get("id")
+    action = MENU_ACTIONS.get(bid)
+    if action:
+        step, prompt = action
+        set_state(sender, step, {})
+        await send_text(sender, prompt)
+
+# -------- SUPPORT --------
+async def handle_support(sender: str, text: str, msg: dict, data: dict):
+    if text.lower().strip() in SUPPORT_EXIT_WORDS:
         reset_state(sender)
-        await show_menu(sender)
+        await send_text(sender, "👋 Support session ended. Type *menu* anytime.")
         return
-
-    if not step:
-        await show_menu(sender)
-        return
-
-    # -------- MENU --------
-    if step == "menu":
-        bid = msg.get("interactive", {}).get("button_reply", {}).get("id")
-        if bid == "book":
-            set_state(sender, "first", {})
-            await send_text(sender, "👤 Enter *First Name*:")
-        elif bid == "report":
-            set_state(sender, "report", {})
-            await send_text(sender, "🆔 Enter *Patient ID* (e.g. P1012):")
-        elif bid == "support":
-            set_state(sender, "support", {})
-            await send_text(sender, "💬 Ask your question. Type *menu* to exit.")
-        return
-
-    # -------- SUPPORT --------
-    if step == "support":
-        if not NLP_SUPPORT_URL:
-            await send_text(sender, "⚠️ Support service not configured.")
-            return
-        try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                r = await client.post(NLP_SUPPORT_URL, json={"query": text})
-                await send_text(sender, r.json().get("answer", "Please be more specific."))
-        except Exception:
-            await send_text(sender, "⚠️ Support is temporarily unavailable.")
+    if not NLP_SUPPORT_URL:
+        await send_text(sender, "⚠️ Support service not configured.")
         return
-
-    # -------- REPORT --------
-    if step == "report":
-        pid = text.upper()
-        doc = db.collection("patients").document(pid).get()
-        if not doc.exists:
+    await send_text(sender, await nlp_support_reply(text))
+
+# -------- REPORT --------
+REPORT_FIELDS = ["FirstName", "LastName", "Department", "RegistrationDate", "RegistrationTime"]
+# Recently mistyped IDs, so retries of the same typo skip Firestore
+_missing_pids = TTLCache(maxsize=1024, ttl=60)
+# Re-requests reuse the summary; staff edits from the dashboard may take
+# up to the 60s TTL to show up here
+_report_summaries = TTLCache(maxsize=1024, ttl=60)
+
+async def handle_report(sender: str, text: str, msg: dict, data: dict):
+    pid = text.upper()
+    summary = _report_summaries.get(pid)
+    if summary is None:
+        doc = None if pid in _missing_pids else \
+            await PATIENTS_COL.document(pid).get(field_paths=REPORT_FIELDS)
+        if doc is None or not doc.exists:
+            _missing_pids[pid] = True
             await send_text(sender, "❌ Patient ID not found. Type *menu*.")
             return
         p = doc.to_dict()
-        await send_text(
-            sender,
+        summary = (
             f"👤 *{p['FirstName']} {p['LastName']}*\n"
             f"🏥 Dept: {p['Department']}\n"
             f"📅 Date: {p['RegistrationDate']}\n"
             f"⏰ Time: {p['RegistrationTime']}"
         )
-        if REPORT_PDF_URL:
-            await send_document(sender, f"{REPORT_PDF_URL}/{pid}", f"{pid}.pdf")
-        reset_state(sender)
+        _report_summaries[pid] = summary
+    reset_state(sender)
+    # One message instead of a summary text followed by the document
+    if REPORT_PDF_URL:
+        await send_document(sender, f"{REPORT_PDF_URL}/{pid}", f"{pid}.pdf", caption=summary)
+    else:
+        await send_text(sender, summary)
+
+# -------- BOOKING --------
+async def handle_first(sender: str, text: str, msg: dict, data: dict):
+    update_state(sender, "last", data, first=text.title())
+    await send_text(sender, "👤 Enter *Last Name*:")
+
+async def handle_last(sender: str, text: str, msg: dict, data: dict):
+    update_state(sender, "department", data, last=text.title())
+    await send_interactive(sender, DEPT_LIST_INTERACTIVE)
+
+async def handle_department(sender: str, text: str, msg: dict, data: dict):
+    reply = msg.get("interactive", {}).get("list_reply")
+    if reply:
+        dept = reply["id"]
+    else:
+        m = _DEPT_RE.search(text.lower())
+        dept = DEPT_ALIASES[m[0]] if m else None
+    if dept not in doctorSchedule:
+        await send_text(sender, "❌ Please select a department from the list.")
         return
+    update_state(sender, "date", data, department=dept)
+    await send_text(sender, "📅 Enter appointment date (YYYY-MM-DD):")
 
-    # -------- BOOKING --------
-    if step == "first":
-        data["first"] = text.title()
-        set_state(sender, "last", data)
-        await send_text(sender, "👤 Enter *Last Name*:")
+async def handle_date(sender: str, text: str, msg: dict, data: dict):
+    parsed = parse_date(text)
+    if not parsed or parsed.date() < datetime.now().date():
+        await send_text(sender, "❌ Invalid or past date.")
         return
+    date = parsed.strftime("%Y-%m-%d")
 
-    if step == "last":
-        data["last"] = text.title()
-        rows = [{"id": d, "title": d} for d in DEPARTMENTS]
-        set_state(sender, "department", data)
-        await send_list(sender, "🏥 Select Department:", rows)
-        return
+    dept = data["department"]
+    slots = DEPT_SLOTS[dept]
+
+    booked = PATIENTS_COL \
+        .where("Department", "==", dept) \
+        .where("RegistrationDate", "==", date) \
+        .select(["RegistrationTime"]) \
+        .stream()
 
-    if step == "department":
-        data["department"] = msg["interactive"]["list_reply"]["id"]
-        set_state(sender, "date", data)
-        await send_text(sender, "📅 Enter appointment date (YYYY-MM-DD):")
+    used = {p.to_dict()["RegistrationTime"] async for p in booked}
+    available = [s for s in slots if s not in used]
+
+    if not available:
+        reset_state(sender)
+        await send_text(sender, "❌ No slots available for this date.")
         return
 
-    if step == "date":
-        parsed = dateparser.parse(text)
-        if not parsed or parsed.date() < now.date():
-            await send_text(sender, "❌ Invalid or past date.")
-            return
-        data["date"] = parsed.strftime("%Y-%m-%d")
+    buttons = [{"id": s, "title": s} for s in available[:3]]
+    update_state(sender, "time", data, date=date)
+    await send_buttons(sender, f"⏰ Available slots ({len(available)} left):", buttons)
 
-        dept = data["department"]
-        start, end = doctorSchedule[dept]
-        slots = generate_slots(start, end)
+async def handle_time(sender: str, text: str, msg: dict, data: dict):
+    reply = msg.get("interactive", {}).get("button_reply")
+    time = reply["id"] if reply else parse_slot_time(text)
+    if time not in DEPT_SLOTS[data["department"]]:
+        await send_text(sender, "❌ Please choose one of the available slots.")
+        return
+    # Both parts are already validated, so skip strptime's format parsing
+    h, minute = map(int, time.split(":"))
+    appt_dt = datetime.combine(dt_date.fromisoformat(data["date"]), dt_time(h, minute))
+    if appt_dt < datetime.now():
+        await send_text(sender, "❌ Past time not allowed.")
+        return
 
-        booked = db.collection("patients") \
-            .where("Department", "==", dept) \
-            .where("RegistrationDate", "==", data["date"]) \
-            .stream()
+    # Firestore auto-id: no read, no same-second collisions. Upper-cased
+    # because handle_report upper-cases whatever the user types.
+    pid = "P" + PATIENTS_COL.document().id[:8].upper()
+    booked = await book_slot({
+        "PatientID": pid,
+        "FirstName": data["first"],
+        "LastName": data["last"],
+        "Department": data["department"],
+        "RegistrationDate": data["date"],
+        "RegistrationTime": time,
+        "Phone": sender,
+        "ReminderAt": appt_dt - timedelta(minutes=10),
+    })
+    if not booked:
+        await send_text(sender, "❌ This slot was just booked. Please pick another.")
+        return
 
-        used = [p.to_dict()["RegistrationTime"] for p in booked]
-        available = [s for s in slots if s not in used]
+    reset_state(sender)
+    await send_text(
+        sender,
+        f"✅ *Appointment Confirmed!*\n"
+        f"🆔 Patient ID: {pid}\n"
+        f"📅 {data['date']} ⏰ {time}\n"
+        f"Please arrive *5 minutes early*."
+    )
+
+STEP_HANDLERS = {
+    "menu": handle_menu,
+    "support": handle_support,
+    "report": handle_report,
+    "first": handle_first,
+    "last": handle_last,
+    "department": handle_department,
+    "date": handle_date,
+    "time": handle_time,
+}
 
-        if not available:
-            await send_text(sender, "❌ No slots available for this date.")
-            reset_state(sender)
-            return
+# Idle locks disappear with their last reference, so this never grows unbounded
+_sender_locks = weakref.WeakValueDictionary()
 
-        buttons = [{"id": s, "title": s} for s in available[:3]]
-        set_state(sender, "time", data)
-        await send_buttons(sender, f"⏰ Available slots ({len(available)} left):", buttons)
+async def process_message(sender: str, text: str, msg: dict):
+    # One message at a time per sender so two deliveries can't both advance a step
+    lock = _sender_locks.setdefault(sender, asyncio.Lock())
+    async with lock:
+        await _process_message(sender, text, msg)
+
+async def _process_message(sender: str, text: str, msg: dict):
+    # Greetings/menu words always restart, so they never need the stored state
+    if text.lower().strip() in MENU_TRIGGERS:
+        reset_state(sender)
+        await show_menu(sender)
         return
 
-    if step == "time":
-        time = msg["interactive"]["button_reply"]["id"]
-        appt_dt = datetime.strptime(f"{data['date']} {time}", "%Y-%m-%d %H:%M")
-        if appt_dt < now:
-            await send_text(sender, "❌ Past time not allowed.")
-            return
+    state = await get_state(sender)
+    step = state.get("step")
+    data = state.get("data", {})
 
-        pid = f"P{int(datetime.utcnow().timestamp())}"
-        db.collection("patients").document(pid).set({
-            "PatientID": pid,
-            "FirstName": data["first"],
-            "LastName": data["last"],
-            "Department": data["department"],
-            "RegistrationDate": data["date"],
-            "RegistrationTime": time,
-            "Phone": sender,
-            "ReminderAt": appt_dt - timedelta(minutes=10),
-        })
-
-        await send_text(
-            sender,
-            f"✅ *Appointment Confirmed!*\n"
-            f"🆔 Patient ID: {pid}\n"
-            f"📅 {data['date']} ⏰ {time}\n"
-            f"Please arrive *5 minutes early*."
-        )
-        reset_state(sender)
+    if not step:
+        await show_menu(sender)
+        return
+
+    handler = STEP_HANDLERS.get(step)
+    if handler:
+        await handler(sender, text, msg, data)
 
 # ---------------- WEBHOOK ----------------
+# Meta re-delivers the same message id when our ack is slow
+_seen_msg_ids = TTLCache(maxsize=20000, ttl=60)
+
 @router.get("/webhook")
 async def verify(request: Request):
     if request.query_params.get("hub.verify_token") == VERIFY_TOKEN:
@@ -309,16 +622,23 @@ async def verify(request: Request):
     raise HTTPException(status_code=403)
 
 @router.post("/webhook")
-async def receive(request: Request):
-    body = await request.json()
-    logger.info("Webhook payload: %s", body)
+async def receive(request: Request, background_tasks: BackgroundTasks):
+    body = orjson.loads(await request.body())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Webhook payload: %s", body)
 
     value = body.get("entry", [{}])[0].get("changes", [{}])[0].get("value", {})
     if "messages" not in value:
         return {"status": "ignored"}
 
     msg = value["messages"][0]
+    mid = msg.get("id")
+    if mid in _seen_msg_ids:
+        return {"status": "duplicate"}
+    if mid:
+        _seen_msg_ids[mid] = True
     sender = msg["from"]
+    logger.info("WA msg from=%s type=%s", sender, msg.get("type"))
 
     text = ""
     if msg.get("text"):
@@ -328,5 +648,6 @@ async def receive(request: Request):
         text = it.get("button_reply", {}).get("title", "") or \
                it.get("list_reply", {}).get("title", "")
 
-    await process_message(sender, text, msg)
+    # Ack Meta right away; the conversation step runs after the response
+    background_tasks.add_task(process_message, sender, text, msg)
     return {"status": "ok"}
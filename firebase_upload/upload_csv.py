@@ -1,14 +1,14 @@
+import asyncio
 import pandas as pd
-import time
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore_async
 
 # -------------------------
 # Initialize Firebase
 # -------------------------
 cred = credentials.Certificate("serviceAccountKey.json")  # path to your Firebase service account key
 firebase_admin.initialize_app(cred)
-db = firestore.client()
+db = firestore_async.client()
 
 # -------------------------
 # Load and clean CSV
@@ -22,20 +22,35 @@ df.columns = df.columns.str.strip()
 print("Columns found in CSV:", df.columns.tolist())  # Debug check
 
 # -------------------------
-# Upload to Firestore with Patient IDs (slow mode)
+# Upload to Firestore with Patient IDs (batched, concurrent)
 # -------------------------
-for idx, row in df.iterrows():
-    patient_data = row.to_dict()
-
-    # Create patient ID like P001, P002, ...
-    patient_id = f"P{str(idx+1).zfill(3)}"
-
-    # Upload with custom document ID
-    db.collection("patients").document(patient_id).set(patient_data)
-
-    print(f"✅ Uploaded {patient_id}")
-
-    # Sleep to avoid quota exceeded (Spark plan allows ~1 write/sec)
-    time.sleep(1.2)
-
-print("🎉 Upload completed successfully! All patients stored with IDs like P001, P002...")
+BATCH_SIZE = 500    # Firestore's per-batch write limit
+MAX_IN_FLIGHT = 16  # concurrent batch commits
+
+patients = db.collection("patients")
+
+async def commit_batch(rows, sem):
+    async with sem:
+        batch = db.batch()
+        for patient_id, patient_data in rows:
+            # Upload with custom document ID
+            batch.set(patients.document(patient_id), patient_data)
+        await batch.commit()
+        print(f"✅ Uploaded {rows[0][0]}..{rows[-1][0]}")
+
+async def main():
+    # Create patient IDs like P001, P002, ...
+    records = df.to_dict(orient="records")
+    rows = [(f"P{idx:03d}", patient_data) for idx, patient_data in enumerate(records, start=1)]
+    chunks = [rows[i:i + BATCH_SIZE] for i in range(0, len(rows), BATCH_SIZE)]
+
+    sem = asyncio.Semaphore(MAX_IN_FLIGHT)
+    results = await asyncio.gather(*(commit_batch(c, sem) for c in chunks), return_exceptions=True)
+
+    failed = [(c[0][0], r) for c, r in zip(chunks, results) if isinstance(r, Exception)]
+    for first_id, err in failed:
+        print(f"❌ Batch starting at {first_id} failed: {err}")
+    if not failed:
+        print("🎉 Upload completed successfully! All patients stored with IDs like P001, P002...")
+
+asyncio.run(main())